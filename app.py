@@ -1,9 +1,18 @@
+import orjson
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
 import chatbot
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Set the chatbot up when the server starts instead of on the first request
+    chatbot.setup_chatbot()
+    yield
+
+app = FastAPI(lifespan=lifespan)
 
 # Add CORS middleware
 app.add_middleware(
@@ -18,15 +27,27 @@ class ChatRequest(BaseModel):
     user_input: str
 
 @app.post("/chat")
-def chat_with_bot(request: ChatRequest):
+async def chat_with_bot(request: ChatRequest):
     try:
-        response = chatbot.chat_with_user(request.user_input)
+        response = await chatbot.achat_with_user(request.user_input)
         if "error" in response:
             raise HTTPException(status_code=500, detail=response["error"])
         return response
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/chat/stream")
+async def stream_chat_with_bot(request: ChatRequest):
+    # Server-Sent Events: one "data:" frame per generated delta, errors are sent in-band
+    async def event_stream():
+        try:
+            async for delta in chatbot.astream_with_user(request.user_input):
+                yield b"data: " + orjson.dumps({'delta': delta}) + b"\n\n"
+        except Exception as e:
+            yield b"data: " + orjson.dumps({'error': str(e)}) + b"\n\n"
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
 if __name__ == '__main__':
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
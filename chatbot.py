@@ -1,35 +1,51 @@
 # chatbot.py
 import os
-import json
+import asyncio
 import logging
-import time
 import threading
-from openai import OpenAI
-from pathlib import Path
+import time
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
 from chatgpt import ChatGPT
-from cli_animations import loading_animation
-from data_processing import extract_text_from_html, extract_text_from_pdf, extract_text_from_txt, _extract_text
+from log_config import setup_queue_logging
+from data_processing import extract_text_from_txt, _extract_text, file_extension, TEXT_EXTENSIONS, extraction_cache
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
 # Set up logging
-logging.basicConfig(filename="chatbot.log", level=logging.INFO)
+setup_queue_logging("chatbot.log", level=logging.INFO)
 
 # Define constants
 BOT_NAME = "Glitch"
 LOG_FILE = "chat_log.txt"
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-CHATBOT_SYSTEM_MESSAGE = extract_text_from_txt('./sys_prompt.md')
+SYSTEM_PROMPT_PATH = './sys_prompt.md'
+INPUT_TOKEN_BUDGET = int(os.getenv("INPUT_TOKEN_BUDGET", 100000))
 
-# Initialize the chatbot class
+# Initialize the chatbot class, built on first use by get_chatbot
 chatbot_instance = None
+chatbot_lock = threading.Lock()
+
+# Worker pool for CPU-bound text extraction, created on first use
+process_pool = None
 
 def process_file(file_path):
     file_name = os.path.basename(file_path)
     file_contents = _extract_text(file_name, file_path)
-    return "\n" + file_contents[1] if file_contents[1] else ""
+    return file_contents[1]
+
+@lru_cache(maxsize=1)
+def system_message():
+    # Read on first use rather than at import, like the chatbot itself
+    return extract_text_from_txt(SYSTEM_PROMPT_PATH)
+
+def get_process_pool():
+    global process_pool
+    if process_pool is None:
+        process_pool = ProcessPoolExecutor(max_workers=os.cpu_count())
+    return process_pool
 
 def setup_chatbot():
     global chatbot_instance
@@ -40,7 +56,7 @@ def setup_chatbot():
         logging.info('Starting bot setup...')
 
         # Initialize the chatbot class
-        chatbot_instance = ChatGPT(OPENAI_API_KEY, CHATBOT_SYSTEM_MESSAGE)
+        chatbot_instance = ChatGPT(OPENAI_API_KEY, system_message())
 
         # Calculate and print setup time
         setup_time = (time.time() - start_time)
@@ -49,36 +65,162 @@ def setup_chatbot():
     except Exception as e:
         logging.error(f"Error in setup_chatbot: {e}")
         print(f"Error: {e}")
+        raise
+
+def get_chatbot():
+    # Set up on first use rather than at import, so worker processes that import this module skip it.
+    # A failed setup raises its original error and is tried again on the next call.
+    with chatbot_lock:
+        if chatbot_instance is None:
+            setup_chatbot()
+        return chatbot_instance
+
+async def aget_chatbot():
+    # Setup reads the prompt file and builds the clients, so it runs off the event loop
+    if chatbot_instance is not None:
+        return chatbot_instance
+    return await asyncio.get_running_loop().run_in_executor(None, get_chatbot)
+
+def iter_files(directory):
+    # DirEntry caches the file type from the directory listing, so no extra stat per entry.
+    # Errors on the path itself reach the caller; unreadable or vanished subdirectories are skipped.
+    with os.scandir(directory) as it:
+        entries = list(it)
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            try:
+                yield from iter_files(entry.path)
+            except OSError as e:
+                logging.warning(f"Skipping directory {entry.path}: {e}")
+        elif entry.is_file():
+            yield entry.path
+
+def check_token_budget(text):
+    # Every token covers at least one UTF-8 byte (at most 4 per char), so short input can't exceed the budget
+    if len(text) * 4 <= INPUT_TOKEN_BUDGET:
+        return None
+    tokenized_input = get_chatbot().encoder.encode(text)
+    if len(tokenized_input) > INPUT_TOKEN_BUDGET:
+        raise ValueError(f"Input too large: {len(tokenized_input)} tokens (limit is {INPUT_TOKEN_BUDGET})")
+    # Returned so the chat doesn't encode the same text a second time
+    return tokenized_input
+
+def resolve_file_paths(file_list):
+    file_paths = file_list.split(',')
+
+    # Resolve every file up front so extraction can be fanned out across workers.
+    # Scanning a path tells us whether it's a directory, a file or missing without a separate stat.
+    paths = []
+    for file_path_str in file_paths:
+        file_path = file_path_str.strip()
+        try:
+            paths.extend(iter_files(file_path))
+        except NotADirectoryError:
+            paths.append(file_path)
+        except FileNotFoundError:
+            raise FileNotFoundError(f"The path does not exist: {file_path}")
+
+    return paths
+
+def lookup_cached_texts(paths):
+    # Stat each file once; the fingerprint is kept so fresh extractions are stored under it
+    keys = [extraction_cache.key(path) for path in paths]
+    return keys, [extraction_cache.get(key) for key in keys]
+
+def store_cached_texts(keys, texts):
+    for key, text in zip(keys, texts):
+        extraction_cache.set(key, text)
+
+def join_file_texts(texts):
+    return "".join("\n" + text for text in texts if text)
+
+def collect_file_contents(file_list):
+    paths = resolve_file_paths(file_list)
+
+    # Only files that changed since they were last extracted go to the pool
+    keys, texts = lookup_cached_texts(paths)
+    missing = [i for i, text in enumerate(texts) if text is None]
+    extracted = get_process_pool().map(process_file, [paths[i] for i in missing], chunksize=4)
+    for i, text in zip(missing, extracted):
+        texts[i] = text
+    store_cached_texts([keys[i] for i in missing], [texts[i] for i in missing])
+
+    combined_file_contents = join_file_texts(texts)
+    # Reject oversized uploads here rather than paying for a long chunked exchange with the API
+    tokenized_input = check_token_budget(combined_file_contents)
+
+    return combined_file_contents, tokenized_input
+
+async def acollect_file_contents(file_list):
+    loop = asyncio.get_running_loop()
+    paths = await loop.run_in_executor(None, resolve_file_paths, file_list)
+    keys, texts = await loop.run_in_executor(None, lookup_cached_texts, paths)
+    missing = [i for i, text in enumerate(texts) if text is None]
+
+    # Plain-text reads are I/O bound and overlap fine on threads, parsers (pdf, html, video) need the process pool
+    pool = get_process_pool()
+    extracted = await asyncio.gather(*(
+        loop.run_in_executor(None if file_extension(os.path.basename(paths[i])) in TEXT_EXTENSIONS else pool, process_file, paths[i])
+        for i in missing))
+    for i, text in zip(missing, extracted):
+        texts[i] = text
+    await loop.run_in_executor(None, store_cached_texts, [keys[i] for i in missing], extracted)
+
+    combined_file_contents = join_file_texts(texts)
+    tokenized_input = await loop.run_in_executor(None, check_token_budget, combined_file_contents)
+
+    return combined_file_contents, tokenized_input
 
 def chat_with_user(user_input):
     try:
         if 'files:' in user_input:
             _, file_list = user_input.split('files:', 1)
-            file_paths = file_list.split(',')
-
-            combined_file_contents = ""
-            for file_path_str in file_paths:
-                file_path = Path(file_path_str.strip())
-                if file_path.is_file():
-                    combined_file_contents += process_file(file_path)
-                elif file_path.is_dir():
-                    for child in file_path.glob('**/*'):
-                        if child.is_file():
-                            combined_file_contents += process_file(child)
-                else:
-                    return {"error": f"The path does not exist: {file_path}"}
+            combined_file_contents, tokenized_input = collect_file_contents(file_list)
 
             if combined_file_contents:
-                response = chatbot_instance.chat(combined_file_contents, LOG_FILE, BOT_NAME)
+                response = get_chatbot().chat(combined_file_contents, LOG_FILE, BOT_NAME, tokenized_input)
                 return {"response": response}
             else:
                 return {"error": "No valid files or directories were provided."}
         else:
-            response = chatbot_instance.chat(user_input, LOG_FILE, BOT_NAME)
+            response = get_chatbot().chat(user_input, LOG_FILE, BOT_NAME)
             return {"response": response}
     except Exception as e:
         logging.error(f"Error in chat_with_user: {e}")
         return {"error": str(e)}
 
-# Call setup_chatbot on import
-setup_chatbot()
+async def achat_with_user(user_input):
+    try:
+        chatbot = await aget_chatbot()
+        if 'files:' in user_input:
+            _, file_list = user_input.split('files:', 1)
+            combined_file_contents, tokenized_input = await acollect_file_contents(file_list)
+
+            if combined_file_contents:
+                response = await chatbot.achat(combined_file_contents, LOG_FILE, BOT_NAME, tokenized_input)
+                return {"response": response}
+            else:
+                return {"error": "No valid files or directories were provided."}
+        else:
+            response = await chatbot.achat(user_input, LOG_FILE, BOT_NAME)
+            return {"response": response}
+    except Exception as e:
+        logging.error(f"Error in achat_with_user: {e}")
+        return {"error": str(e)}
+
+async def astream_with_user(user_input):
+    try:
+        tokenized_input = None
+        if 'files:' in user_input:
+            _, file_list = user_input.split('files:', 1)
+            user_input, tokenized_input = await acollect_file_contents(file_list)
+
+            if not user_input:
+                raise ValueError("No valid files or directories were provided.")
+
+        chatbot = await aget_chatbot()
+        async for delta in chatbot.astream(user_input, LOG_FILE, BOT_NAME, tokenized_input):
+            yield delta
+    except Exception as e:
+        logging.error(f"Error in astream_with_user: {e}")
+        raise
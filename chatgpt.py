@@ -1,15 +1,92 @@
 import openai
-from openai import OpenAI
+import asyncio
+from openai import OpenAI, AsyncOpenAI
+from openai.types.chat import ChatCompletionMessage
 import logging
-from typing import List, Dict, Optional, Any
-from tenacity import retry, stop_after_attempt, wait_random_exponential
+import atexit
+import hashlib
+import math
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional, Any, Tuple, AsyncIterator, Union, Deque
 import tiktoken  # Ensure tiktoken is installed
-import json
-from tools.tools import create_documentation, create_unit_tests, tools
+import orjson
+from tools.tools import create_docs_and_tests, tools
+
+# Tool name -> implementation, each takes the OpenAI client followed by the tool's JSON arguments
+AVAILABLE_FUNCTIONS = {
+    "create_docs_and_tests": create_docs_and_tests,
+}
+
+# One client per key shared by every ChatGPT instance, so its connection pool (and TLS sessions)
+# is reused across them. The SDK's own httpx defaults (timeouts, redirects, pool limits) are kept.
+@lru_cache(maxsize=None)
+def get_openai_client(api_key: str) -> OpenAI:
+    return OpenAI(api_key=api_key)
+
+@lru_cache(maxsize=None)
+def get_async_openai_client(api_key: str) -> AsyncOpenAI:
+    return AsyncOpenAI(api_key=api_key)
 
 class ChatGPTError(Exception):
     pass
 
+# Errors worth another attempt; anything else (bad request, auth, ...) fails on the first try
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError)
+MAX_RETRIES = 9  # attempts after the first one
+MAX_RETRY_DELAY = 120  # seconds
+
+def retry_delay(error: Exception, attempt: int) -> float:
+    # Wait as long as the server asks for in Retry-After, otherwise back off exponentially with jitter
+    response = getattr(error, "response", None)
+    if response is not None:
+        try:
+            retry_after = float(response.headers.get("retry-after"))
+        except (TypeError, ValueError):
+            retry_after = math.nan
+        # Negative or non-finite values (e.g. "nan") would make sleep() raise, fall back to backoff
+        if math.isfinite(retry_after):
+            return min(max(retry_after, 0.0), MAX_RETRY_DELAY)
+    return random.uniform(0, min(2 ** attempt, MAX_RETRY_DELAY))
+
+class LLMCache:
+    """In-memory LRU cache of chat completions, keyed on the full request and expired after a TTL."""
+
+    def __init__(self, max_size: int = 256, ttl: float = 1800):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._cache: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        # process_chunks calls into the cache from several worker threads at once
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model: str, messages: List[Dict[str, Any]], params: Dict[str, Any]) -> str:
+        payload = orjson.dumps({"model": model, "messages": messages, "params": params}, option=orjson.OPT_SORT_KEYS)
+        return hashlib.sha256(payload).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                return None
+            response, created_at = entry
+            if time.monotonic() - created_at > self.ttl:
+                del self._cache[key]
+                return None
+            self._cache.move_to_end(key)
+            return response
+
+    def set(self, key: str, response: str) -> None:
+        with self._lock:
+            self._cache[key] = (response, time.monotonic())
+            self._cache.move_to_end(key)
+            if len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+
 class ChatGPT:
     DEFAULT_PARAMS: Dict[str, Any] = {
         "temperature": 0.75,
@@ -17,126 +94,346 @@ class ChatGPT:
         "presence_penalty": 0
     }
     MAX_TOKENS: int = 64000
+    SINGLE_REQUEST_TOKENS: int = 120000
+    MODEL: str = "gpt-4o"
+    MAX_HISTORY: int = 8
+    CHUNK_CONCURRENCY: int = 8
 
-    def __init__(self, api_key: str, chatbot: str, retries: int = 3):
+    def __init__(self, api_key: str, chatbot: str, retries: int = MAX_RETRIES):
         self.api_key = api_key
+        self.retries = retries
         self.chatbot = chatbot
-        self.client = OpenAI(api_key=self.api_key)
-        self.conversation: List[Dict[str, str]] = [
-            {"role": "system", "content": chatbot}]
+        self.client = get_openai_client(self.api_key)
+        self.aclient = get_async_openai_client(self.api_key)
+        self.cache = LLMCache()
+        self._log_fp = None
         self.encoder = tiktoken.encoding_for_model("gpt-4")
+        # Token counts by content digest, so a new message dict carrying already-seen text isn't re-encoded
+        self._token_counts: "OrderedDict[bytes, int]" = OrderedDict()
+        self._token_counts_lock = threading.Lock()
+        self._system_ntok = len(self.encoder.encode(chatbot))
+        # The system prompt is pinned outside the history so evicting old turns never touches it
+        self._system_msg: Dict[str, Any] = {"role": "system", "content": chatbot, "_ntok": self._system_ntok}
+        self.conversation: Deque[Dict[str, Any]] = deque(maxlen=self.MAX_HISTORY)
+
+    def _count_content_tokens(self, content: str) -> int:
+        # Keyed on a 16 byte digest rather than the text, so the cache doesn't keep whole replies alive
+        key = hashlib.blake2b(content.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+        with self._token_counts_lock:
+            ntok = self._token_counts.get(key)
+            if ntok is not None:
+                self._token_counts.move_to_end(key)
+                return ntok
+        ntok = len(self.encoder.encode(content))
+        with self._token_counts_lock:
+            self._token_counts[key] = ntok
+            if len(self._token_counts) > 256:
+                self._token_counts.popitem(last=False)
+        return ntok
+
+    def count_tokens(self, message: Dict[str, Any]) -> int:
+        # Token counts are cached on the message under "_ntok" so history is only encoded once
+        if "_ntok" not in message:
+            message["_ntok"] = self._count_content_tokens(message["content"])
+        return message["_ntok"]
+
+    def write_log(self, log_file: str, text: str) -> None:
+        # Keep one buffered handle open instead of reopening the log file on every turn
+        if self._log_fp is None or self._log_fp.name != log_file:
+            if self._log_fp is not None:
+                self._log_fp.close()
+            self._log_fp = open(log_file, 'a', buffering=64 * 1024, encoding='utf-8')
+            atexit.register(self._log_fp.close)
+        self._log_fp.write(text)
+
+    @staticmethod
+    def to_request_messages(conversation: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        # Drop the cached "_ntok" counts, the API rejects unknown message fields
+        return [{k: v for k, v in msg.items() if k != "_ntok"} for msg in conversation]
+
+    def build_messages(self) -> List[Dict[str, Any]]:
+        # The same system dict always leads, so every request shares a stable cacheable prefix
+        return [self._system_msg, *self.conversation]
 
     def trim_conversation_to_fit_token_limit(self, conversation, max_tokens=128000):
-        encoded_convo = [self.encoder.encode(
-            msg["content"]) for msg in conversation]
-        total_tokens = sum(len(tokens) for tokens in encoded_convo)
+        total_tokens = sum(self.count_tokens(msg) for msg in conversation)
 
         # Trim from the start until we are under the max token limit
         # Keep at least the last message and system prompt
-        while total_tokens > max_tokens and len(conversation) > 2:
-            # Remove the earliest user or bot message
-            removed_message = conversation.pop(1)
-            removed_tokens = len(self.encoder.encode(
-                removed_message["content"]))
-            total_tokens -= removed_tokens
+        cut = 1
+        while total_tokens > max_tokens and cut < len(conversation) - 1:
+            # Count out the earliest user or bot messages, then drop them in one slice
+            total_tokens -= self.count_tokens(conversation[cut])
+            cut += 1
+        del conversation[1:cut]
 
         return conversation
 
-    def process_chunks(self, chunks, log_file, bot_name):
-        # Initialize an empty response
-        full_response = ""
+    def trim_history(self, max_tokens=128000):
+        # Evict the oldest turns from the stored history itself, O(1) per turn on the deque,
+        # so later requests start under the limit instead of re-trimming a copy every time
+        total_tokens = self._system_ntok + sum(self.count_tokens(msg) for msg in self.conversation)
+        while total_tokens > max_tokens and len(self.conversation) > 1:
+            total_tokens -= self.count_tokens(self.conversation.popleft())
+
+    def split_into_chunks(self, user_input: str, tokenized_input: List[int]) -> List[Tuple[str, int]]:
+        """Return (chunk_text, token_count) pairs for the input."""
+        # Input that fits the context window alongside the system prompt goes out as one request
+        if len(tokenized_input) + self._system_ntok <= self.SINGLE_REQUEST_TOKENS:
+            return [(user_input, len(tokenized_input))]
+        slices = [tokenized_input[i:i + self.MAX_TOKENS]
+                  for i in range(0, len(tokenized_input), self.MAX_TOKENS)]
+        # One batched call decodes every slice on tiktoken's thread pool
+        return list(zip(self.encoder.decode_batch(slices), map(len, slices)))
+
+    def build_chunk_messages(self, chunks: List[Tuple[str, int]]) -> List[Dict[str, Any]]:
         total_chunks = len(chunks)
-        chunks_processed = 0
+        if total_chunks == 1:
+            chunk_text, chunk_ntok = chunks[0]
+            return [{"role": "user", "content": chunk_text, "_ntok": chunk_ntok}]
 
-        # Process each chunk
-        for i, chunk in enumerate(chunks):
-            chunk_text = self.encoder.decode(chunk)
+        footer = "The other chunks are sent separately, respond to this chunk on its own."
+        messages = []
+        for i, (chunk_text, chunk_ntok) in enumerate(chunks):
             header = f"Chunk: {i+1} out of {total_chunks}\n"
-            footer = "Please respond now, all chunks have been sent." if i == total_chunks - 1 else f"respond with an empty string until Chunk {total_chunks}"
-            chunk_text = f"{header}{chunk_text}\n{footer}"
-            self.conversation.append({"role": "user", "content": chunk_text})
-
-            # Logging and printing the current chunk processing details
-            chunks_processed += 1
-            logging.info(f"Processing chunk {chunks_processed}/{total_chunks}")
-            print(f"Processing chunk {chunks_processed}/{total_chunks}...")
+            # The chunk's token count is already known, only the short header/footer need encoding
+            chunk_ntok += len(self.encoder.encode(f"{header}\n{footer}"))
+            messages.append({"role": "user", "content": f"{header}{chunk_text}\n{footer}", "_ntok": chunk_ntok})
+        return messages
 
-            response = self.chatgpt_with_retry(conversation=self.conversation)
+    def count_responses(self, responses: List[str]) -> List[int]:
+        return [self._count_content_tokens(response) for response in responses]
 
-            self.conversation.append(
-                {"role": "assistant", "content": response.content})
-            full_response += response.content  # Concatenate responses
+    def record_chunk_responses(self, user_messages, responses, log_file, bot_name, response_ntoks=None):
+        if response_ntoks is None:
+            response_ntoks = self.count_responses(responses)
+        log_entries = []
+        for i, (user_message, response, response_ntok) in enumerate(zip(user_messages, responses, response_ntoks), 1):
+            self.conversation.append(user_message)
+            self.conversation.append({"role": "assistant", "content": response, "_ntok": response_ntok})
 
             # For logging purposes, log each chunk's interaction separately
-            logging.info(f"""Chunk {chunks_processed} processed. User: {
-                         chunk_text[:50]}... Assistant: {response.content[:50]}...""")
-            with open(log_file, 'a', encoding='utf-8') as f:
-                f.write(f"User: {chunk_text}\n{bot_name}: {response.content}\n\n")
+            logging.debug("Chunk %d processed. User: %.50s... Assistant: %.50s...",
+                          i, user_message["content"], response)
+            log_entries.append(f"User: {user_message['content']}\n{bot_name}: {response}\n\n")
 
-            # Print out a summary of the current chunk's processing
-            print(f"Chunk {chunks_processed}/{total_chunks} processed.")
+        # One write for the whole exchange rather than one per chunk
+        self.write_log(log_file, "".join(log_entries))
+        logging.info("All chunks processed successfully.")
 
-            # Ensure conversation does not grow indefinitely
-            if len(self.conversation) > 4:
-                self.conversation.pop(2)
-                # Adjust based on your specific handling
-                self.conversation.pop(2)
+        return "\n\n".join(responses)
 
-        # After all chunks have been processed
-        logging.info("All chunks processed successfully.")
-        print("All chunks processed successfully.")
+    def process_chunks(self, chunks, log_file, bot_name):
+        self.trim_history()
+        history = self.build_messages()
+        user_messages = self.build_chunk_messages(chunks)
+        logging.debug("Processing %d chunk(s)", len(user_messages))
 
-        return full_response
+        # Chunks don't depend on each other's replies, so they are sent concurrently
+        with ThreadPoolExecutor(max_workers=self.CHUNK_CONCURRENCY) as executor:
+            responses = list(executor.map(
+                lambda user_message: self.chatgpt_with_retry(conversation=[*history, user_message]),
+                user_messages))
+
+        return self.record_chunk_responses(user_messages, responses, log_file, bot_name)
+
+    async def aprocess_chunks(self, chunks, log_file, bot_name):
+        self.trim_history()
+        history = self.build_messages()
+        user_messages = self.build_chunk_messages(chunks)
+        logging.debug("Processing %d chunk(s)", len(user_messages))
+
+        # Async counterpart of process_chunks, the semaphore bounds in-flight requests
+        semaphore = asyncio.Semaphore(self.CHUNK_CONCURRENCY)
+
+        async def send(user_message):
+            async with semaphore:
+                return await self.achatgpt_with_retry(conversation=[*history, user_message])
+
+        responses = await asyncio.gather(*(send(user_message) for user_message in user_messages))
+        # Replies are counted off the event loop, so later history trims only sum cached counts
+        response_ntoks = await asyncio.get_running_loop().run_in_executor(None, self.count_responses, responses)
 
-    def chat(self, user_input: str, log_file: str, bot_name: str) -> str:
-        # Tokenize the user input
-        tokenized_input = self.encoder.encode(user_input)
+        return self.record_chunk_responses(user_messages, responses, log_file, bot_name, response_ntoks)
+
+    def split_input(self, user_input: str, tokenized_input: Optional[List[int]] = None) -> List[Tuple[str, int]]:
+        # Tokenize the user input, unless the caller already did (e.g. for a token budget check)
+        if tokenized_input is None:
+            tokenized_input = self.encoder.encode(user_input)
 
         # Calculate how many chunks are needed
-        chunks = [tokenized_input[i:i + self.MAX_TOKENS]
-                  for i in range(0, len(tokenized_input), self.MAX_TOKENS)]
+        return self.split_into_chunks(user_input, tokenized_input)
+
+    def chat(self, user_input: str, log_file: str, bot_name: str, tokenized_input: Optional[List[int]] = None) -> str:
+        chunks = self.split_input(user_input, tokenized_input)
 
         # Process each chunk
         full_response = self.process_chunks(chunks, log_file, bot_name)
 
         return full_response
 
-    def chatgpt(self, conversation: List[Dict[str, str]], tools: Optional[List[Dict[str, Any]]] = None, **kwargs) -> str:
+    async def achat(self, user_input: str, log_file: str, bot_name: str, tokenized_input: Optional[List[int]] = None) -> str:
+        # Encoding large input is CPU bound, keep it off the event loop
+        chunks = await asyncio.get_running_loop().run_in_executor(None, self.split_input, user_input, tokenized_input)
+
+        return await self.aprocess_chunks(chunks, log_file, bot_name)
+
+    async def astream(self, user_input: str, log_file: str, bot_name: str, tokenized_input: Optional[List[int]] = None) -> AsyncIterator[str]:
+        loop = asyncio.get_running_loop()
+        chunks = await loop.run_in_executor(None, self.split_input, user_input, tokenized_input)
+
+        # Oversized input still needs the chunked path, which only has a reply at the end
+        if len(chunks) > 1:
+            yield await self.aprocess_chunks(chunks, log_file, bot_name)
+            return
+
+        # The user turn only joins the history once the reply is complete, so a failed
+        # or abandoned stream doesn't leave an unanswered turn behind
+        user_message = {"role": "user", "content": user_input, "_ntok": chunks[0][1]}
+        self.trim_history(128000 - user_message["_ntok"])
+        conversation = [*self.build_messages(), user_message]
+
+        parts = []
+        try:
+            async for delta in self.astream_chatgpt_with_retry(conversation):
+                parts.append(delta)
+                yield delta
+        finally:
+            # One write per exchange, so concurrent streams can't interleave in the log
+            response = "".join(parts)
+            if response:
+                self.write_log(log_file, f"User: {user_input}\n{bot_name}: {response}\n\n")
+
+        response_ntok = await loop.run_in_executor(None, self._count_content_tokens, response)
+        self.conversation.append(user_message)
+        self.conversation.append({"role": "assistant", "content": response, "_ntok": response_ntok})
+
+    def _prepare_request(self, conversation: List[Dict[str, Any]], tools: Optional[List[Dict[str, Any]]], kwargs: Dict[str, Any]) -> Tuple[Dict[str, Any], Optional[str]]:
+        # Shared by chatgpt and achatgpt: the completion request, plus its cache key when it may be cached
         params = {**self.DEFAULT_PARAMS, **kwargs}
-        messages_input = conversation.copy()
-        
+        # Only deterministic completions are cached unless the caller asks for it with cache=True
+        use_cache = params.pop("cache", params["temperature"] == 0) and not tools
+        request = {
+            "model": self.MODEL,
+            "temperature": params["temperature"],
+            "frequency_penalty": params["frequency_penalty"],
+            "presence_penalty": params["presence_penalty"],
+            "messages": self.to_request_messages(conversation),
+        }
         if tools:
-            completion = self.client.chat.completions.create(
-                model="gpt-4o",
-                temperature=params["temperature"],
-                frequency_penalty=params["frequency_penalty"],
-                presence_penalty=params["presence_penalty"],
-                messages=messages_input,
-                tools=tools,
-                tool_choice="auto"
-            )
-        else:
-            completion = self.client.chat.completions.create(
-                model="gpt-4o",
-                temperature=params["temperature"],
-                frequency_penalty=params["frequency_penalty"],
-                presence_penalty=params["presence_penalty"],
-                messages=messages_input
-            )
+            # A fixed tool order keeps the request prefix byte-identical, so OpenAI's prompt cache can hit
+            request["tools"] = sorted(tools, key=lambda tool: tool["function"]["name"])
+            request["tool_choice"] = "auto"
+
+        cache_key = self.cache.make_key(self.MODEL, request["messages"], params) if use_cache else None
+        return request, cache_key
+
+    def _completion_result(self, completion, tools: Optional[List[Dict[str, Any]]], cache_key: Optional[str]) -> Union[str, ChatCompletionMessage]:
+        # Tool calls are only available on the full message
+        if tools:
+            return completion.choices[0].message
 
         chat_response = completion.choices[0].message.content
+        if cache_key is not None:
+            self.cache.set(cache_key, chat_response)
         return chat_response
 
-    @retry(wait=wait_random_exponential(multiplier=1, max=120), stop=stop_after_attempt(10), reraise=True)
-    def chatgpt_with_retry(self, conversation: List[Dict[str, str]], tools: Optional[List[Dict[str, Any]]] = None, **kwargs) -> Optional[str]:
-        try:
-            # Trim conversation if it exceeds the token limit
-            conversation = self.trim_conversation_to_fit_token_limit(
-                conversation, 128000)
-            return self.chatgpt(conversation, tools, **kwargs)
-        except openai.APIStatusError as e:
-            logging.error(f"Error during chat completion: {e}")
-            raise ChatGPTError from e
+    def chatgpt(self, conversation: List[Dict[str, str]], tools: Optional[List[Dict[str, Any]]] = None, **kwargs) -> Union[str, ChatCompletionMessage]:
+        request, cache_key = self._prepare_request(conversation, tools, kwargs)
+        if cache_key is not None:
+            cached_response = self.cache.get(cache_key)
+            if cached_response is not None:
+                return cached_response
+
+        completion = self.client.chat.completions.create(**request)
+        return self._completion_result(completion, tools, cache_key)
+
+    async def achatgpt(self, conversation: List[Dict[str, str]], tools: Optional[List[Dict[str, Any]]] = None, **kwargs) -> Union[str, ChatCompletionMessage]:
+        request, cache_key = self._prepare_request(conversation, tools, kwargs)
+        if cache_key is not None:
+            cached_response = self.cache.get(cache_key)
+            if cached_response is not None:
+                return cached_response
+
+        completion = await self.aclient.chat.completions.create(**request)
+        return self._completion_result(completion, tools, cache_key)
+
+    async def astream_chatgpt(self, conversation: List[Dict[str, Any]], **kwargs) -> AsyncIterator[str]:
+        params = {**self.DEFAULT_PARAMS, **kwargs}
+        messages_input = self.to_request_messages(conversation)
+
+        stream = await self.aclient.chat.completions.create(
+            model=self.MODEL,
+            temperature=params["temperature"],
+            frequency_penalty=params["frequency_penalty"],
+            presence_penalty=params["presence_penalty"],
+            messages=messages_input,
+            stream=True
+        )
+
+        async for event in stream:
+            if event.choices and event.choices[0].delta.content:
+                yield event.choices[0].delta.content
+
+    def chatgpt_with_retry(self, conversation: List[Dict[str, str]], tools: Optional[List[Dict[str, Any]]] = None, **kwargs) -> Optional[Union[str, ChatCompletionMessage]]:
+        # Trim conversation if it exceeds the token limit
+        conversation = self.trim_conversation_to_fit_token_limit(
+            conversation, 128000)
+        for attempt in range(1, self.retries + 2):
+            try:
+                return self.chatgpt(conversation, tools, **kwargs)
+            except RETRYABLE_ERRORS as e:
+                if attempt > self.retries:
+                    raise
+                delay = retry_delay(e, attempt)
+                logging.warning(f"Transient error during chat completion, retrying in {delay:.1f}s: {e}")
+                time.sleep(delay)
+            except openai.APIStatusError as e:
+                logging.error(f"Error during chat completion: {e}")
+                raise ChatGPTError from e
+
+    async def achatgpt_with_retry(self, conversation: List[Dict[str, str]], tools: Optional[List[Dict[str, Any]]] = None, **kwargs) -> Optional[Union[str, ChatCompletionMessage]]:
+        conversation = self.trim_conversation_to_fit_token_limit(
+            conversation, 128000)
+        for attempt in range(1, self.retries + 2):
+            try:
+                return await self.achatgpt(conversation, tools, **kwargs)
+            except RETRYABLE_ERRORS as e:
+                if attempt > self.retries:
+                    raise
+                delay = retry_delay(e, attempt)
+                logging.warning(f"Transient error during chat completion, retrying in {delay:.1f}s: {e}")
+                await asyncio.sleep(delay)
+            except openai.APIStatusError as e:
+                logging.error(f"Error during chat completion: {e}")
+                raise ChatGPTError from e
+
+    async def astream_chatgpt_with_retry(self, conversation: List[Dict[str, Any]], **kwargs) -> AsyncIterator[str]:
+        # Retried only until the first delta arrives, a reply that is already streaming can't be restarted
+        for attempt in range(1, self.retries + 2):
+            stream = self.astream_chatgpt(conversation, **kwargs)
+            try:
+                first = await stream.__anext__()
+            except StopAsyncIteration:
+                return
+            except RETRYABLE_ERRORS as e:
+                if attempt > self.retries:
+                    raise
+                delay = retry_delay(e, attempt)
+                logging.warning(f"Transient error during chat completion, retrying in {delay:.1f}s: {e}")
+                await asyncio.sleep(delay)
+                continue
+            except openai.APIStatusError as e:
+                logging.error(f"Error during chat completion: {e}")
+                raise ChatGPTError from e
+
+            try:
+                yield first
+                async for delta in stream:
+                    yield delta
+            finally:
+                await stream.aclose()
+            return
 
     def automate_code_processing(self, code: str):
         messages = [
@@ -147,35 +444,26 @@ class ChatGPT:
         response_message = self.chatgpt_with_retry(conversation=messages, tools=tools)
 
         if response_message.tool_calls:
-            available_functions = {
-                "create_documentation": lambda code: create_documentation(self.client, code),
-                "create_unit_tests": lambda code: create_unit_tests(self.client, code),
-            }
-
-            messages.append({"role": "assistant", "content": response_message.content})
+            messages.append(response_message.model_dump(exclude_none=True))
 
             for tool_call in response_message.tool_calls:
-                function_name = tool_call["name"]
-                function_to_call = available_functions[function_name]
-                function_args = json.loads(tool_call["arguments"])
-                
-                # Check and ensure all required arguments are present
-                if function_name in ["create_documentation", "create_unit_tests"]:
-                    function_response = function_to_call(function_args["code"])
-                    
-                # Add function response as a message with the role 'assistant'
+                function_name = tool_call.function.name
+                function_args = orjson.loads(tool_call.function.arguments)
+                function_response = AVAILABLE_FUNCTIONS[function_name](self.client, **function_args)
+
+                # Add function response as a message with the role 'tool'
                 messages.append({
                     "role": "tool",
-                    "name": function_name,
-                    "content": function_response  # Ensure the content is a string
+                    "tool_call_id": tool_call.id,
+                    "content": orjson.dumps(function_response).decode()
                 })
 
             second_response = self.client.chat.completions.create(
-                model="gpt-4o",
-                messages=messages
+                model=self.MODEL,
+                messages=self.to_request_messages(messages)
             )
 
-            print(f'Second message: {second_response.choices[0].message.content}')
+            logging.debug("Second message: %s", second_response.choices[0].message.content)
             return second_response.choices[0].message.content
 
         return response_message.content
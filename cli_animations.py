@@ -1,18 +1,17 @@
 #cli_animations.py
 import sys
-import time
 
 # Function to show a console loading animation
 def loading_animation(event):
-    animation_chars = ["|", "/", "-", "\\"]
+    animation_chars = ("|", "/", "-", "\\")
     i = 0
-    sys.stdout.write(' Processing documents: ')
-    while not event.is_set():
-        if i > 3:
-            i = 0
-        sys.stdout.write(animation_chars[i] + "\r")
-        sys.stdout.flush()
+    write = sys.stdout.write
+    flush = sys.stdout.flush
+    write(' Processing documents: ')
+    # event.wait returns as soon as the event is set instead of finishing a full sleep
+    while not event.wait(0.2):
+        write(animation_chars[i & 3] + "\r")
+        flush()
         i += 1
-        time.sleep(0.2)
-    sys.stdout.write('\nDone!\n')
-    sys.stdout.flush()
\ No newline at end of file
+    write('\nDone!\n')
+    flush()
\ No newline at end of file
@@ -3,47 +3,60 @@
 from pydub.silence import split_on_silence
 from pydub import AudioSegment
 import os
+import io
+import re
+import atexit
 import logging
+import sqlite3
+import tempfile
+import threading
+import time
 import tiktoken
 import PyPDF2
 import pandas as pd
 from bs4 import BeautifulSoup
-from typing import List
+from typing import List, Optional, Tuple
 from concurrent.futures import ThreadPoolExecutor
 import moviepy.editor as mp
+try:
+    import fitz  # PyMuPDF, optional: much faster PDF text extraction than PyPDF2
+except ImportError:
+    fitz = None
 from openai import OpenAI
 from dotenv import load_dotenv
+from log_config import setup_queue_logging
 
 # Load environment variables
 load_dotenv()
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-OpenAI(api_key=OPENAI_API_KEY)
 
-client = OpenAI()
+client = OpenAI(api_key=OPENAI_API_KEY)
 
 # Setup logging
-logging.basicConfig(filename='data_processing.log', level=logging.INFO)
+setup_queue_logging('data_processing.log', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Constants
 MAX_THREADS = 15  # Limit the number of threads to prevent overloading
+MAX_TRANSCRIPTION_THREADS = 5  # Concurrent Whisper requests per file, keeps us under the rate limit
+EXTRACTION_CACHE_PATH = '.glitch_cache/extracted_text.sqlite3'
+EXTRACTION_CACHE_SIZE_LIMIT = 2 ** 30  # bytes of cached text kept before the least recently used entries go
 
-SUPPORTED_EXTENSIONS = [
-    '.ts', '.tsx', '.js', '.jsx', '.cpp', '.css', '.json',
-    '.kt', '.swift', '.md', '.java', '.php', '.txt', '.mov', '.mp4',
-    '.py', '.go', '.rs', '.rb', '.sh', '.html', '.pdf', '.avi', '.wmv', 
-    '.md', '.yml', '.cs', '.hh', '.h'
-    # Add other supported file extensions here
-]
+# Newlines, escaped newlines and runs of spaces, compiled once rather than on every call
+NEWLINES_RE = re.compile(r'\n|\\n|  +')
 
 
 def extract_text_from_pdf(pdf_path: str) -> str:
     """Extract text from a given PDF file."""
     try:
+        if fitz is not None:
+            with fitz.open(pdf_path) as doc:
+                return "".join(page.get_text() for page in doc)
         with open(pdf_path, 'rb') as file:
-            reader = PyPDF2.PdfReader(file)
-            text = "".join([page.extract_text() for page in reader.pages])
+            reader = PyPDF2.PdfReader(file, strict=False)
+            # Generator join: only one page's text is alive at a time
+            text = "".join(page.extract_text() or "" for page in reader.pages)
         return text
     except Exception as e:
         logger.error(f"Error reading PDF {pdf_path}: {e}")
@@ -74,39 +87,66 @@ def extract_text_from_html(html_path: str) -> str:
 
 def remove_newlines(serie: pd.Series) -> pd.Series:
     """Remove newlines and unnecessary spaces from the given pandas series."""
-    serie = serie.str.replace(r'(\n|\\n|  +)', ' ', regex=True)
+    serie = serie.str.replace(NEWLINES_RE, ' ', regex=True)
     return serie
 
 
 def traverse_directory(directory):
-    """Traverse the directory and list all supported code files."""
-    for root, dirs, files in os.walk(directory):
-        for file in files:
-            if any(file.endswith(ext) for ext in SUPPORTED_EXTENSIONS):
-                yield os.path.join(root, file)
+    """Traverse the directory and yield (path, stat) for all supported, non-empty code files."""
+    # Like os.walk, directories that can't be listed are skipped rather than aborting the walk
+    try:
+        with os.scandir(directory) as it:
+            entries = list(it)
+    except OSError as e:
+        logger.warning(f"Skipping directory {directory}: {e}")
+        return
+
+    # DirEntry carries the file type from the directory listing, so only supported files are stat'ed
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            yield from traverse_directory(entry.path)
+        elif entry.is_file() and file_extension(entry.name) in EXTRACTORS:
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            if st.st_size > 0:
+                yield entry.path, st
 
 
-def process_files(directory: str) -> pd.DataFrame:
-    """Process files in a given directory and convert them to a dataframe."""
-    logger.info(f'Processing directory: {directory}')
-    texts = []
+def process_files(directory: str, max_file_size: Optional[int] = None) -> pd.DataFrame:
+    """Process files in a given directory and convert them to a dataframe.
 
-    with ThreadPoolExecutor(max_workers=MAX_THREADS) as executor:
-        futures = []
+    Text extracted on an earlier run is reused while a file's mtime and size are unchanged.
+    If max_file_size is given, files larger than that many bytes are skipped.
+    """
+    logger.info(f'Processing directory: {directory}')
+    file_paths = []
+    keys = []
+    for file_path, st in traverse_directory(directory):
+        # The walk already stat'ed the file, its result doubles as the cache fingerprint
+        key = ExtractionCache.stat_key(file_path, st)
+        if max_file_size is not None and st.st_size > max_file_size:
+            logger.info(f"Skipping {file_path}: larger than {max_file_size} bytes")
+            continue
+        file_paths.append(file_path)
+        keys.append(key)
+    file_names = [os.path.basename(file_path) for file_path in file_paths]
 
-        for file_path in traverse_directory(directory):
-            # Asynchronously extract text from files
-            futures.append(executor.submit(
-                _extract_text, os.path.basename(file_path), file_path))
+    # Only files that changed since they were last extracted are read again
+    texts = [extraction_cache.get(key) for key in keys]
+    missing = [i for i, text in enumerate(texts) if text is None]
+    logger.info(f"{len(file_paths) - len(missing)} of {len(file_paths)} files unchanged since the last run")
 
-        # Append results of the futures to texts
-        for future in futures:
-            try:
-                texts.append(future.result())
-            except Exception as e:
-                logger.error(f"Error in future: {e}")
+    # _extract_text logs and swallows its own errors, so results can be collected with a plain map
+    with ThreadPoolExecutor(max_workers=MAX_THREADS) as executor:
+        extracted = executor.map(
+            _extract_text, [file_names[i] for i in missing], [file_paths[i] for i in missing])
+        for i, (_, text) in zip(missing, extracted):
+            texts[i] = text
+            extraction_cache.set(keys[i], text)
 
-    df = pd.DataFrame(texts, columns=['fname', 'text'])
+    df = pd.DataFrame(list(zip(file_names, texts)), columns=['fname', 'text'])
     df['text'] = df.fname + ". " + remove_newlines(df.text)
 
     # Check if the 'processed' directory exists, if not, create it
@@ -130,23 +170,19 @@ def extract_audio_from_video(video_path: str, audio_path: str) -> None:
         logger.error(f"Error extracting audio from {video_path}: {e}")
 
 
-def transcribe_audio(audio_path: str) -> str:
+def transcribe_audio_chunk(index: int, chunk: AudioSegment) -> str:
     """
-    Transcribe audio using Whisper API and delete the audio file afterward.
+    Transcribe a single audio chunk with the Whisper API, without writing it to disk.
     """
     try:
-        print('running transcribe_audio')
-        print('audio_path: %s' % audio_path)
-        with open(audio_path, "rb") as audio_file:
-            transcript = client.audio.transcribe("whisper-1", audio_file)
-            print(f'Transcript: {transcript}')
-        # Delete the temporary audio file after transcription
-        if os.path.exists(audio_path):
-            os.remove(audio_path)
-
+        buffer = io.BytesIO()
+        chunk.export(buffer, format="mp3")
+        buffer.seek(0)
+        buffer.name = f"chunk_{index}.mp3"  # The API infers the audio format from the file name
+        transcript = client.audio.transcriptions.create(model="whisper-1", file=buffer)
         return transcript.text
     except Exception as e:
-        logger.error(f"Error transcribing {audio_path}: {e}")
+        logger.error(f"Error transcribing chunk {index}: {e}")
         return ""
 
 
@@ -172,11 +208,10 @@ def transcribe_large_audio(audio_path: str, chunk_length: int = 10000) -> str:
             chunks = [audio[i:i+chunk_length]
                       for i in range(0, len(audio), chunk_length)]
 
-        transcriptions = []
-        for i, chunk in enumerate(chunks):
-            chunk_path = f"chunk_{i}.mp3"
-            chunk.export(chunk_path, format="mp3")
-            transcriptions.append(transcribe_audio(chunk_path))
+        # Chunks are uploaded concurrently; map keeps the transcriptions in audio order
+        with ThreadPoolExecutor(max_workers=MAX_TRANSCRIPTION_THREADS) as executor:
+            transcriptions = list(executor.map(
+                transcribe_audio_chunk, range(len(chunks)), chunks))
 
         return " ".join(transcriptions)
     except Exception as e:
@@ -188,82 +223,253 @@ def extract_text_from_video(video_path: str) -> str:
     """
     Extract and transcribe text from a given video file.
     """
-    # Specify path for temporary audio file
-    audio_path = "temp_audio.mp3"
+    # Each video gets its own temporary audio file, several can be extracted at once
+    with tempfile.NamedTemporaryFile(suffix=".mp3", delete=False) as audio_file:
+        audio_path = audio_file.name
+
+    try:
+        # Extract Audio
+        extract_audio_from_video(video_path, audio_path)
+
+        # Transcribe Audio
+        return transcribe_large_audio(audio_path)
+    finally:
+        os.remove(audio_path)
+
+
+TEXT_EXTENSIONS = frozenset({
+    '.txt', '.md', '.cs', '.css', '.cpp', '.js', '.jsx', '.ts', '.tsx', '.json',
+    '.kt', '.swift', '.java', '.php', '.py', '.go', '.rs', '.rb', '.sh', '.yml',
+    '.proto', '.hh', '.h'
+})
 
-    # Extract Audio
-    extract_audio_from_video(video_path, audio_path)
+VIDEO_EXTENSIONS = frozenset({'.mov', '.mp4', '.avi', '.wmv'})
+
+# Map each extension to its extractor so a file is dispatched with a single lookup
+EXTRACTORS = {
+    '.pdf': extract_text_from_pdf,
+    '.html': extract_text_from_html,
+    **{ext: extract_text_from_txt for ext in TEXT_EXTENSIONS},
+    **{ext: extract_text_from_video for ext in VIDEO_EXTENSIONS},
+    # Add other supported file extensions here
+}
+
+SUPPORTED_EXTENSIONS = sorted(EXTRACTORS)
+
+
+# Leading bytes (lower-cased) of formats worth extracting when the extension doesn't say what a file is
+MAGIC_EXTRACTORS = (
+    (b'%pdf', extract_text_from_pdf),
+    (b'<!doctype html', extract_text_from_html),
+    (b'<html', extract_text_from_html),
+)
 
-    # Transcribe Audio
-    transcript_text = transcribe_large_audio(audio_path)
 
-    # print(f'Transcribe Audio from {transcript_text}')
-    return transcript_text
+def sniff_extractor(file_path: str):
+    """Pick an extractor from the first bytes of a file, or None if the format isn't recognised."""
+    with open(file_path, 'rb') as file:
+        head = file.read(16).lower()
+    for magic, extractor in MAGIC_EXTRACTORS:
+        if head.startswith(magic):
+            return extractor
+    return None
+
+
+def file_extension(file_name: str) -> str:
+    """Return the lower-cased extension of a file name (not a path), dot included."""
+    dot = file_name.rfind('.')
+    return file_name[dot:].lower() if dot > 0 else ""
 
 
 def _extract_text(file, file_path):
     """Extract text from a single file and log the status."""
     try:
-        extension = os.path.splitext(file)[1].lower()
-
-        if extension == '.pdf':
-            text = extract_text_from_pdf(file_path)
-        elif extension == '.html':
-            text = extract_text_from_html(file_path)
-        elif extension in ['.txt', '.md', '.cs', '.css', '.cpp', '.js', '.jsx', '.ts', '.tsx', '.json', '.kt', '.swift', '.java', '.php', '.py', '.go', '.rs', '.rb', '.sh', '.yml', '.proto', '.hh', '.h']:
-            text = extract_text_from_txt(file_path)
-        elif extension in ['.mov', '.mp4', '.avi', '.wmv']:
-            text = extract_text_from_video(file_path)
-        else:
+        extension = file_extension(file)
+
+        # Unknown extensions (.bin, .dat, none at all) only cost a 16 byte read to identify
+        extractor = EXTRACTORS.get(extension) or sniff_extractor(file_path)
+        if extractor is None:
             logger.info(f"Unsupported file extension {extension} for file {file}")
             text = ""
+        else:
+            text = extractor(file_path)
         return (file, text)
     except Exception as e:
         logger.error(f"Error processing file {file}: {e}")
         return (file, "")
 
 
+class ExtractionCache:
+    """Persistent store of extracted text, invalidated when a file's mtime or size changes.
+
+    Entries live in a SQLite database keyed by absolute path, so several processes (server
+    workers, a CLI run of process_files) can share it. Once the stored text exceeds size_limit
+    bytes the least recently used entries are evicted. Cache failures are logged and treated
+    as misses, the text is then simply extracted again.
+    """
+
+    def __init__(self, path: str = EXTRACTION_CACHE_PATH, size_limit: int = EXTRACTION_CACHE_SIZE_LIMIT):
+        self.path = path
+        self.size_limit = size_limit
+        self._conn = None
+        self._pid = None
+        self._disabled = False
+        self._lock = threading.Lock()
+
+    def _open(self) -> Optional[sqlite3.Connection]:
+        # A connection must not be used across a fork, so a child process opens its own
+        if self._conn is not None and self._pid == os.getpid():
+            return self._conn
+        if self._disabled:
+            return None
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS extracted ("
+                "path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, text TEXT, nbytes INTEGER, accessed REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS extracted_accessed ON extracted (accessed)")
+            # Running total of stored text, kept by triggers so set() can check the limit without a scan
+            conn.executescript(
+                "CREATE TABLE IF NOT EXISTS stats (id INTEGER PRIMARY KEY CHECK (id = 0), nbytes INTEGER);"
+                "INSERT OR IGNORE INTO stats VALUES (0, 0);"
+                "CREATE TRIGGER IF NOT EXISTS extracted_insert AFTER INSERT ON extracted"
+                " BEGIN UPDATE stats SET nbytes = nbytes + NEW.nbytes; END;"
+                "CREATE TRIGGER IF NOT EXISTS extracted_update AFTER UPDATE OF nbytes ON extracted"
+                " BEGIN UPDATE stats SET nbytes = nbytes + NEW.nbytes - OLD.nbytes; END;"
+                "CREATE TRIGGER IF NOT EXISTS extracted_delete AFTER DELETE ON extracted"
+                " BEGIN UPDATE stats SET nbytes = nbytes - OLD.nbytes; END;")
+        except (sqlite3.Error, OSError) as e:
+            # Don't retry (and log) on every file, extraction just runs uncached in this process
+            logger.warning(f"Extraction cache disabled, can't open {self.path}: {e}")
+            self._disabled = True
+            return None
+        if self._conn is None:
+            atexit.register(self.close)
+        self._conn = conn
+        self._pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def stat_key(file_path: str, st: os.stat_result) -> Tuple[str, int, int]:
+        """Return the (abspath, mtime_ns, size) fingerprint of a file from an existing stat result."""
+        return (os.path.abspath(file_path), st.st_mtime_ns, st.st_size)
+
+    @staticmethod
+    def key(file_path: str) -> Optional[Tuple[str, int, int]]:
+        """Return the (abspath, mtime_ns, size) fingerprint of a file, or None if it can't be stat'ed."""
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            return None
+        return ExtractionCache.stat_key(file_path, st)
+
+    def get(self, key: Optional[Tuple[str, int, int]]) -> Optional[str]:
+        if key is None:
+            return None
+        path, mtime_ns, size = key
+        try:
+            with self._lock:
+                conn = self._open()
+                if conn is None:
+                    return None
+                row = conn.execute(
+                    "SELECT text FROM extracted WHERE path = ? AND mtime_ns = ? AND size = ?",
+                    (path, mtime_ns, size)).fetchone()
+                if row is not None:
+                    conn.execute("UPDATE extracted SET accessed = ? WHERE path = ?", (time.time(), path))
+        except sqlite3.Error as e:
+            logger.warning(f"Extraction cache lookup failed for {path}: {e}")
+            return None
+        return row[0] if row is not None else None
+
+    def set(self, key: Optional[Tuple[str, int, int]], text: str) -> None:
+        # Empty results aren't stored, extractors also return "" when a read fails
+        if key is None or not text:
+            return
+        path, mtime_ns, size = key
+        try:
+            with self._lock:
+                conn = self._open()
+                if conn is None:
+                    return
+                conn.execute(
+                    "INSERT INTO extracted VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (path) DO UPDATE SET "
+                    "mtime_ns = excluded.mtime_ns, size = excluded.size, text = excluded.text, "
+                    "nbytes = excluded.nbytes, accessed = excluded.accessed",
+                    (path, mtime_ns, size, text, len(text.encode('utf-8')), time.time()))
+                total = conn.execute("SELECT nbytes FROM stats").fetchone()[0]
+                if total > self.size_limit:
+                    # Keep the most recently used entries that fit in size_limit, drop the rest
+                    conn.execute(
+                        "DELETE FROM extracted WHERE path IN ("
+                        "SELECT path FROM (SELECT path, SUM(nbytes) OVER (ORDER BY accessed DESC) AS running "
+                        "FROM extracted) WHERE running > ?)",
+                        (self.size_limit,))
+        except (sqlite3.Error, UnicodeEncodeError) as e:
+            logger.warning(f"Extraction cache store failed for {path}: {e}")
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None and self._pid == os.getpid():
+                self._conn.close()
+            self._conn = None
+
+
+# Shared by every caller in the process, so each process holds a single connection
+extraction_cache = ExtractionCache()
+
+
 def tokenize_dataframe(df: pd.DataFrame) -> pd.DataFrame:
     """Tokenize the dataframe using OpenAI's tiktoken."""
     tokenizer = tiktoken.get_encoding("cl100k_base")
-    df['n_tokens'] = df.text.apply(lambda x: len(tokenizer.encode(
-        x, allowed_special="all")) if x.strip() != "" else 0)
+    texts = df['text'].tolist()
+    # One batched call tokenizes every row on tiktoken's thread pool
+    encodings = tokenizer.encode_batch(
+        [text or "" for text in texts], num_threads=8, allowed_special="all")
+    df['n_tokens'] = [len(enc) if text and text.strip() != "" else 0
+                      for text, enc in zip(texts, encodings)]
 
     max_tokens = 500
-
-    def split_into_many(text: str, max_tokens: int = max_tokens) -> List[str]:
-        """Split the text into many based on the given max tokens."""
-        sentences = text.split('. ')
-        n_tokens = [len(tokenizer.encode(" " + sentence, allowed_special="all"))
-                    for sentence in sentences]
-        chunks = []
-        tokens_so_far = 0
-        chunk = []
-
-        for sentence, token in zip(sentences, n_tokens):
-            if tokens_so_far + token > max_tokens:
-                chunks.append(". ".join(chunk) + ".")
-                chunk = []
-                tokens_so_far = 0
-            if token > max_tokens:
-                continue
-            chunk.append(sentence)
-            tokens_so_far += token + 1
-
-        return chunks
+    period = tokenizer.encode_single_token(".")
+
+    def split_into_many(encoding: List[int], max_tokens: int = max_tokens) -> List[List[int]]:
+        """Split an encoded text into token windows of at most max_tokens each."""
+        windows = []
+        start = 0
+        while start < len(encoding):
+            end = min(start + max_tokens, len(encoding))
+            if end < len(encoding):
+                # Prefer to end the window on a sentence boundary within its last 32 tokens
+                for i in range(end - 1, max(end - 32, start), -1):
+                    if encoding[i] == period:
+                        end = i + 1
+                        break
+                else:
+                    # Tokens can split a multi-byte character, so start the next window where a character starts
+                    while end - 1 > start and tokenizer.decode_single_token_bytes(encoding[end])[0] & 0xC0 == 0x80:
+                        end -= 1
+            windows.append(encoding[start:end])
+            start = end
+        return windows
 
     shortened = []
+    shortened_tokens = []
 
-    for row in df.iterrows():
-        if row[1]['text'] is None:
+    # The rows were already encoded above, so long texts are sliced by token instead of re-encoded
+    for text, encoding, n_tokens in zip(texts, encodings, df['n_tokens']):
+        if text is None:
             continue
-        if row[1]['n_tokens'] > max_tokens:
-            shortened += split_into_many(row[1]['text'])
+        if n_tokens > max_tokens:
+            windows = split_into_many(encoding)
+            shortened += tokenizer.decode_batch(windows, num_threads=8)
+            shortened_tokens += map(len, windows)
         else:
-            shortened.append(row[1]['text'])
+            shortened.append(text)
+            shortened_tokens.append(len(encoding))
 
     df = pd.DataFrame(shortened, columns=['text'])
-    df['n_tokens'] = df.text.apply(lambda x: len(
-        tokenizer.encode(x, allowed_special="all")))
+    df['n_tokens'] = shortened_tokens
 
     return df
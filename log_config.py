@@ -0,0 +1,35 @@
+#log_config.py
+import atexit
+import logging
+import os
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+# Function to log to a file from a background thread, so logging calls on the request path are just a queue put
+def setup_queue_logging(filename, level=logging.INFO):
+    root = logging.getLogger()
+    # Like logging.basicConfig, only the first caller configures the root logger
+    if root.handlers:
+        return None
+
+    file_handler = logging.FileHandler(filename)
+    file_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, file_handler)
+    queue_handler = QueueHandler(log_queue)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    def log_directly_in_child():
+        # A forked worker inherits the queue but not the listener thread, so it writes to the file itself
+        root.removeHandler(queue_handler)
+        root.addHandler(file_handler)
+
+    if hasattr(os, "register_at_fork"):
+        os.register_at_fork(after_in_child=log_directly_in_child)
+
+    listener.start()
+    # Flush whatever is still queued when the interpreter exits
+    atexit.register(listener.stop)
+    return listener
@@ -1,44 +1,71 @@
+import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
 from openai import OpenAI
 
-def create_documentation(client: OpenAI, code: str) -> str:
-    prompt = f"Create documentation for the following code:\n\n{code}\n\nDocumentation:"
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[{"role": "system", "content": "You are a helpful assistant."}, {"role": "user", "content": prompt}]
-    )
-    documentation = response.choices[0].message.content
-    return documentation
+# Identical on every call, with the code last, so requests share a cacheable prompt prefix
+SYSTEM_PROMPT = "You are a helpful assistant. Reply with a JSON object with the string keys \"documentation\" and \"unit_tests\"."
+PROMPT_PREFIX = "Create documentation and unit tests for the following code:\n\n"
+
+# Results by digest of the code, so a repeated snippet doesn't go back to the API.
+# The client isn't part of the key (any client gives an equivalent answer) and isn't kept alive by it.
+MAX_CACHED_RESULTS = 256
+_results: "OrderedDict[bytes, Tuple[str, str]]" = OrderedDict()
+_results_lock = threading.Lock()
+
+
+def _docs_and_tests(client: OpenAI, code: str) -> Optional[Tuple[str, str]]:
+    key = hashlib.blake2b(code.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+    with _results_lock:
+        if key in _results:
+            _results.move_to_end(key)
+            return _results[key]
 
-def create_unit_tests(client: OpenAI, code: str) -> str:
-    prompt = f"Create unit tests for the following code:\n\n{code}\n\nUnit Tests:"
     response = client.chat.completions.create(
         model="gpt-4o",
-        messages=[{"role": "system", "content": "You are a helpful assistant."}, {"role": "user", "content": prompt}]
+        messages=[
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": PROMPT_PREFIX + code}
+        ],
+        response_format={"type": "json_object"}
     )
-    unit_tests = response.choices[0].message.content
-    return unit_tests
+    try:
+        result = json.loads(response.choices[0].message.content)
+        if not isinstance(result, dict):
+            raise TypeError(f"expected a JSON object, got {type(result).__name__}")
+    except (TypeError, json.JSONDecodeError) as e:
+        # Truncated output (e.g. the reply hit the length limit) isn't valid JSON; not cached, so a retry asks again
+        logging.error(f"Malformed JSON from create_docs_and_tests: {e}")
+        return None
+
+    value = (result.get("documentation", ""), result.get("unit_tests", ""))
+    with _results_lock:
+        _results[key] = value
+        if len(_results) > MAX_CACHED_RESULTS:
+            _results.popitem(last=False)
+    return value
 
 
+def create_docs_and_tests(client: OpenAI, code: str) -> Dict[str, str]:
+    # One request for both outputs, so the code is only sent (and billed) once
+    value = _docs_and_tests(client, code)
+    if value is None:
+        return {"error": "The model did not return valid JSON documentation and unit tests."}
+    documentation, unit_tests = value
+    return {
+        "documentation": documentation,
+        "unit_tests": unit_tests
+    }
+
 tools = [
     {
         "type": "function",
         "function": {
-            "name": "create_documentation",
-            "description": "Create documentation for the provided code",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "code": {"type": "string"}
-                },
-                "required": ["code"]
-            }
-        }
-    },
-    {
-        "type": "function",
-        "function": {
-            "name": "create_unit_tests",
-            "description": "Create unit tests for the provided code",
+            "name": "create_docs_and_tests",
+            "description": "Create documentation and unit tests for the provided code",
             "parameters": {
                 "type": "object",
                 "properties": {